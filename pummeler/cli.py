@@ -1,27 +1,19 @@
 from __future__ import division, print_function
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import partial
-from glob import glob
+from io import StringIO
 import os
 from pathlib import Path
 import sys
 import traceback
 
-import h5py
 import numpy as np
-import pandas as pd
-
-from .featurize import (
-    get_embeddings,
-    read_file_chunks,
-    LinearFeaturizer,
-    RFFFeaturizer,
-    MyAdditiveExtras,
-)
-from .misc import get_state_embeddings, get_merged_embeddings
+
 from .reader import VERSIONS
-from .stats import load_stats, save_stats
-from .sort import sort_by_region, get_puma_to_region
+
+# The rest of our imports (pandas, h5py, scipy, sklearn, ...) are slow, so they're
+# done inside the commands that need them; that keeps `pummel --help` snappy.
 
 
 def main():
@@ -35,7 +27,30 @@ def main():
     )
     subparsers = parser.add_subparsers()
 
-    ############################################################################
+    # Only build the parser for the command being run, if we can tell what it
+    # is; otherwise (e.g. for `pummel --help`) build all of them.
+    cmd = sys.argv[1] if len(sys.argv) > 1 else None
+    if cmd in _subcommands:
+        _subcommands[cmd](subparsers)
+    else:
+        for add_parser in _subcommands.values():
+            add_parser(subparsers)
+
+    args = parser.parse_args()
+    args.func(args, parser)
+
+
+def _positive_int(s):
+    try:
+        n = int(s)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, not {s!r}")
+    return n
+
+
+def _add_sort_parser(subparsers):
     sort = subparsers.add_parser(
         "sort", help="Sort the data by region and collect statistics about it."
     )
@@ -72,9 +87,19 @@ def main():
     io.add_argument(
         "--chunksize",
         type=int,
-        default=10 ** 5,
+        default=None,
         metavar="LINES",
-        help="How much of a CSV file to read at a time; default " "%(default)s.",
+        help="How much of a CSV file to read at a time; default is based on "
+        "available memory, and at least 100000.",
+    )
+    io.add_argument(
+        "--jobs",
+        "-j",
+        type=_positive_int,
+        default=1,
+        metavar="N",
+        help="Number of processes to read CSV files in parallel with, when "
+        "there's more than one; default %(default)s.",
     )
     io.add_argument(
         "--stats-only",
@@ -107,16 +132,20 @@ def main():
         help="The format of the ACS PUMS files in use; default " "%(default)s.",
     )
 
-    ############################################################################
+
+def _add_featurize_parser(subparsers):
     featurize = subparsers.add_parser(
         "featurize", help="Emit features for a given region."
     )
     featurize.set_defaults(func=do_featurize)
 
     io = featurize.add_argument_group("Input/output options")
-    io.add_argument("dir", help="The directory where `pummel sort` put stuff.")
+    io.add_argument(
+        "dir", type=Path, help="The directory where `pummel sort` put stuff."
+    )
     io.add_argument(
         "outfile",
+        type=Path,
         nargs="?",
         help="Where to put embeddings; default DIR/embeddings.npz.",
     )
@@ -129,9 +158,20 @@ def main():
     io.add_argument(
         "--chunksize",
         type=int,
-        default=2 ** 13,
+        default=None,
         metavar="LINES",
-        help="How much of a region to process at a time; default " "%(default)s.",
+        help="How much of a region to process at a time; default is based on "
+        "available memory, between 8192 and 131072.",
+    )
+    io.add_argument(
+        "--jobs",
+        "-j",
+        type=_positive_int,
+        default=1,
+        metavar="N",
+        help="Number of processes to featurize regions in parallel with; "
+        "default %(default)s. Each process uses its own multithreaded BLAS, "
+        "so you may want to limit it with e.g. OMP_NUM_THREADS.",
     )
     g = io.add_mutually_exclusive_group()
     g.add_argument(
@@ -145,6 +185,23 @@ def main():
     )
     g.add_argument("--save-uncompressed", action="store_false", dest="save_compressed")
     g = io.add_mutually_exclusive_group()
+    g.add_argument(
+        "--save-float32",
+        action="store_const",
+        dest="save_dtype",
+        const="float32",
+        help="Save the embeddings as 32-bit floats, which halves their size "
+        "(and helps --save-compressed). They're still computed in 64 bits.",
+    )
+    g.add_argument(
+        "--save-float64",
+        action="store_const",
+        dest="save_dtype",
+        const="float64",
+        help="Save the embeddings as 64-bit floats (default).",
+    )
+    g.set_defaults(save_dtype="float64")
+    g = io.add_mutually_exclusive_group()
     g.add_argument(
         "--save-npz",
         action="store_const",
@@ -203,6 +260,15 @@ def main():
         default=None,
         help="Random seed for generating random frequencies. " "Default: none",
     )
+    g = emb.add_mutually_exclusive_group()
+    g.add_argument(
+        "--cache-freqs",
+        action="store_true",
+        default=True,
+        help="If --seed is given, save the random frequencies and bandwidth "
+        "in DIR, and reuse them in later runs with the same settings (default).",
+    )
+    g.add_argument("--no-cache-freqs", action="store_false", dest="cache_freqs")
     emb.add_argument(
         "--skip-feats",
         nargs="+",
@@ -251,16 +317,18 @@ def main():
         "'SEX == 2 & AGEP > 45, SEX == 2 & PINCP < 20000'.",
     )
 
-    ############################################################################
+
+def _add_export_parser(subparsers):
     export = subparsers.add_parser(
         "export", help="Export features in embeddings.npz as CSV files."
     )
     export.set_defaults(func=do_export)
 
     io = export.add_argument_group("Input/output options")
-    io.add_argument("dir", help="Where to put the outputs.")
+    io.add_argument("dir", type=Path, help="Where to put the outputs.")
     io.add_argument(
         "infile",
+        type=Path,
         nargs="?",
         help="Location of embeddings created by `pummel feauturize`"
         "; default DIR/embeddings.npz.",
@@ -274,7 +342,8 @@ def main():
         "otherwise 'embeddings'.",
     )
 
-    ############################################################################
+
+def _add_merge_parser(subparsers):
     merge = subparsers.add_parser(
         "merge-features",
         help="Get embeddings for larger areas from existing embeddings.",
@@ -316,7 +385,8 @@ def main():
         help="Where to output; default adds _states/_merged to the " "input file name.",
     )
 
-    ############################################################################
+
+def _add_weight_counts_parser(subparsers):
     weight_counts = subparsers.add_parser(
         "weight-counts",
         help="Export total weight per region (approximately "
@@ -325,34 +395,56 @@ def main():
     weight_counts.set_defaults(func=do_weight_counts)
 
     io = weight_counts.add_argument_group("Input/output options")
-    io.add_argument("dir", help="Where the feature files live.")
+    io.add_argument("dir", type=Path, help="Where the feature files live.")
     io.add_argument(
         "outfile",
+        type=Path,
         default=None,
         nargs="?",
         help="Where to output; default DIR/weight_counts.csv.",
     )
 
-    ############################################################################
-    args = parser.parse_args()
-    args.func(args, parser)
+
+_subcommands = {
+    "sort": _add_sort_parser,
+    "featurize": _add_featurize_parser,
+    "export": _add_export_parser,
+    "merge-features": _add_merge_parser,
+    "weight-counts": _add_weight_counts_parser,
+}
 
 
 def do_sort(args, parser):
+    from .stats import load_stats, save_stats
+    from .sort import sort_by_region, HousingSource
+
     args.out_dir.mkdir(parents=True, exist_ok=True)
 
+    if args.chunksize is None:
+        info = VERSIONS[args.version]
+        n_cols = sum(
+            len(info[k])
+            for k in [
+                "meta_cols",
+                "weight_cols",
+                "real_feats",
+                "discrete_feats",
+                "alloc_flags",
+            ]
+        )
+        # each of the --jobs processes reads its own chunks
+        args.chunksize = _pick_chunksize(
+            n_cols * 8, 10 ** 5, 10 ** 6, mem_frac=0.1 / args.jobs
+        )
+
     if args.housing_dir is None:
         housing_source = None
     else:
         hs = load_stats(args.housing_dir / "stats")
-        get_name = get_puma_to_region(
-            hs["region_type"], hs["version_info"]["region_year"]
+        housing_source = HousingSource(
+            args.housing_dir, hs["region_type"], hs["version_info"]["region_year"]
         )
 
-        def housing_source(st, puma):
-            name = get_name((st, puma))
-            return next(iter(args.housing_dir.glob(f"feats_{name}.*")))
-
     stats = sort_by_region(
         args.zipfile or args.csv_files,
         str(args.out_dir / "feats_{}"),
@@ -366,20 +458,30 @@ def do_sort(args, parser):
         add_extension=True,
         housing_source=housing_source,
         housing_cache_size=args.housing_cache_size,
+        n_jobs=args.jobs,
     )
-    save_stats(os.path.join(args.out_dir, "stats"), stats)
+    save_stats(args.out_dir / "stats", stats)
 
 
 def do_featurize(args, parser):
+    from .featurize import (
+        get_embeddings,
+        _num_feats,
+        LinearFeaturizer,
+        RFFFeaturizer,
+        MyAdditiveExtras,
+    )
+    from .stats import load_stats
+
     if args.outfile is None:
         ext = {"hdf5": "h5", "npz": "npz"}
-        args.outfile = os.path.join(
-            args.dir, "embeddings.{}".format(ext.get(args.format, args.format))
+        args.outfile = args.dir / "embeddings.{}".format(
+            ext.get(args.format, args.format)
         )
 
-    if os.path.exists(args.outfile):
+    if args.outfile.exists():
         if args.force:
-            os.remove(args.outfile)
+            args.outfile.unlink()
         else:
             parser.error(
                 (
@@ -387,17 +489,35 @@ def do_featurize(args, parser):
                     "to override it."
                 ).format(args.outfile)
             )
-    if not os.path.isdir(os.path.dirname(args.outfile)):
+    if not args.outfile.parent.is_dir():
         parser.error(
             "Directory {} doesn't exist; is that what you meant?".format(
-                os.path.dirname(args.outfile)
+                args.outfile.parent
             )
         )
 
-    dirname = Path(args.dir)
-    stats = load_stats(dirname / 'stats')
-    files = glob(dirname.glob('feats_*'))
-    region_names = [f.stem[6:] for f in files]
+    feats = _list_feats(args.dir)
+    if not feats:
+        parser.error(
+            "No feats_* files in {}; did you run `pummel sort`?".format(args.dir)
+        )
+    region_names, files = (list(x) for x in zip(*feats))
+
+    stats = load_stats(args.dir / "stats")
+
+    if args.chunksize is None:
+        # dummy features, plus angles and their sines and cosines for RFFs
+        row_bytes = _num_feats(stats) * 8
+        target = None
+        if not args.skip_rbf:
+            row_bytes += 3 * args.n_freqs * 8
+            # try to make each RFF projection a big enough matrix multiply for
+            # BLAS to be efficient at, about 256MB of output
+            target = 256 * 2 ** 20 // (args.n_freqs * 8)
+        # each of the --jobs processes has its own buffers of this size
+        args.chunksize = _pick_chunksize(
+            row_bytes, 2 ** 13, 2 ** 17, mem_frac=0.1 / args.jobs, target=target
+        )
 
     if args.do_my_proc or args.do_my_additive:
         from .my_proc import MyPreprocessor
@@ -420,6 +540,10 @@ def do_featurize(args, parser):
         else np.random.RandomState(args.seed)
     )
 
+    # without --seed, the seeds below are random, so there's no point caching
+    use_cache = args.cache_freqs and args.seed is not None
+    freqs_cache_dir = args.dir if use_cache else None
+
     featurizers = [skipify(LinearFeaturizer)]
     if not args.skip_rbf:
         featurizers.append(
@@ -429,6 +553,7 @@ def do_featurize(args, parser):
                 n_freqs=args.n_freqs,
                 bandwidth=args.bandwidth,
                 orthogonal=args.rff_orthogonal,
+                cache_dir=freqs_cache_dir,
             )
         )
     if args.do_my_additive:
@@ -441,6 +566,7 @@ def do_featurize(args, parser):
         chunksize=args.chunksize,
         subsets=args.subsets,
         preprocessor=preprocessor,
+        n_jobs=args.jobs,
     )
 
     res = {
@@ -470,18 +596,87 @@ def do_featurize(args, parser):
         res["one_freqs"] = m.one_freqs
         res["pair_freqs"] = m.pair_freqs
         res["extra_keep_multilevels"] = m.keep_multilevels
+        del m
+
+    # Everything we need is in res now. Drop our references to the stats (the
+    # featurizers and preprocessor each hold a processed copy) and to the
+    # original embeddings, so that they can be freed before we make any float32
+    # copies and write the output.
+    del stats, preprocessor, featurizers, embeddings
+
+    for k in res:
+        if k.startswith("emb_"):
+            res[k] = np.ascontiguousarray(res[k], dtype=args.save_dtype)
 
     _save_embeddings(
         args.outfile, res, format=args.format, compressed=args.save_compressed
     )
 
 
+def _available_memory():
+    "Bytes of memory currently available, or None if we can't tell."
+    try:
+        import psutil
+    except ImportError:
+        pass
+    else:
+        return psutil.virtual_memory().available
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _pick_chunksize(row_bytes, min_size, max_size, mem_frac=0.1, target=None):
+    """
+    Picks a number of lines to work on at once, so that chunks of row_bytes-sized
+    lines take up about mem_frac of the available memory. Bigger chunks amortize
+    the per-chunk overhead of pandas' parsing, BLAS calls, and so on.
+
+    If target is given, goes up to that many lines if possible, but never past
+    max_size or what the available memory allows.
+    """
+    avail = _available_memory()
+    mem_size = None if avail is None else int(mem_frac * avail / row_bytes)
+    if mem_size is None:
+        chunksize = min_size
+    else:
+        chunksize = max(min_size, min(max_size, mem_size))
+
+    if target is not None:
+        upper = max_size if mem_size is None else min(max_size, mem_size)
+        chunksize = max(chunksize, min(target, upper))
+    print("Using --chunksize {}".format(chunksize), file=sys.stderr)
+    return chunksize
+
+
+_feats_exts = {".pq", ".parquet", ".h5", ".hdf5"}
+
+
+def _list_feats(dirname):
+    """
+    Finds the region files from `pummel sort` in dirname, in one pass over the
+    directory. Returns a sorted list of (region name, path) pairs.
+    """
+    feats = []
+    with os.scandir(dirname) as it:
+        for entry in it:
+            base, ext = os.path.splitext(entry.name)
+            if base.startswith("feats_") and ext in _feats_exts:
+                feats.append((base[len("feats_") :], entry.path))
+    feats.sort()
+    return feats
+
+
 def _save_embeddings(outfile, res, format="npz", compressed=False):
     try:
         if format == "npz":
             fn = np.savez_compressed if compressed else np.savez
             fn(outfile, **res)
         elif format == "hdf5":
+            import h5py
+
             with h5py.File(outfile, "w") as f:
                 for k, v in res.items():
                     if k == "subset_queries" and v is None:
@@ -518,7 +713,7 @@ def _save_embeddings(outfile, res, format="npz", compressed=False):
 
 def do_export(args, parser):
     if args.infile is None:
-        args.infile = os.path.join(args.dir, "embeddings.npz")
+        args.infile = args.dir / "embeddings.npz"
 
     if args.out_name is None:
         rel = os.path.relpath(args.infile, args.dir)
@@ -526,25 +721,102 @@ def do_export(args, parser):
             args.out_name = "embeddings"
         else:
             args.out_name = rel[:-4] if rel.endswith(".npz") else rel
-    out_pattern = os.path.join(args.dir, args.out_name + "_{}.csv")
+    out_pattern = str(args.dir / (args.out_name + "_{}.csv"))
+
+    # (mmap_mode doesn't do anything for npz files, so stream the members instead)
+    with np.load(args.infile, allow_pickle=False) as data:
+        region_names = data["region_names"]
 
-    with np.load(args.infile) as data:
         path = out_pattern.format("linear")
-        df = pd.DataFrame(data["emb_lin"])
-        df.set_index(data["region_names"], inplace=True)
-        df.columns = data["feature_names"]
-        df.to_csv(path, index_label="region")
+        _write_csv_blocks(
+            path,
+            _iter_npz_blocks(data, "emb_lin"),
+            region_names,
+            columns=data["feature_names"],
+        )
         print("Linear embeddings saved in {}".format(path))
 
         if "emb_rff" in data:
             path = out_pattern.format("rff")
-            df = pd.DataFrame(data["emb_rff"])
-            df.set_index(data["region_names"], inplace=True)
-            df.to_csv(path, index_label="region")
+            _write_float_csv_blocks(
+                path, _iter_npz_blocks(data, "emb_rff"), region_names
+            )
             print("Fourier embeddings saved in {}".format(path))
 
 
+def _iter_npz_blocks(data, key, blocksize=1024):
+    """
+    Yields blocks of rows from the 2d array `key` in the open npz file `data`,
+    reading them straight out of the zip member rather than loading it all.
+    Always yields at least one (possibly empty) block, so that writers still
+    get the number of columns and can write a header.
+    """
+    fmt = np.lib.format
+    with data.zip.open(key + ".npy") as f:
+        version = fmt.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = fmt.read_array_header_1_0(f)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = fmt.read_array_header_2_0(f)
+        else:
+            shape = None
+
+        if shape is not None and len(shape) == 2 and not fortran_order:
+            if dtype.hasobject:
+                raise ValueError(f"{key} is an object array; can't export it")
+            row_bytes = dtype.itemsize * shape[1]
+            for start in range(0, max(shape[0], 1), blocksize):
+                n = min(blocksize, shape[0] - start)
+                buf = f.read(n * row_bytes)
+                yield np.frombuffer(buf, dtype=dtype).reshape(n, shape[1])
+            return
+
+    emb = data[key]
+    for start in range(0, max(emb.shape[0], 1), blocksize):
+        yield emb[start : start + blocksize]
+
+
+def _write_csv_blocks(path, blocks, region_names, columns=None):
+    import pandas as pd
+
+    # to_csv on the whole thing builds giant string buffers; go a block at a time
+    with open(path, "w", newline="") as f:
+        start = 0
+        for block in blocks:
+            df = pd.DataFrame(
+                block,
+                index=region_names[start : start + block.shape[0]],
+                columns=columns,
+            )
+            df.to_csv(f, header=start == 0, index_label="region")
+            start += block.shape[0]
+
+
+def _write_float_csv_blocks(path, blocks, region_names):
+    """
+    Like _write_csv_blocks, for matrices that are all floats with columns
+    labeled 0, 1, ...: skips building DataFrames and formats with np.savetxt.
+    Uses enough digits that the values round-trip exactly.
+    """
+    with open(path, "w") as f:
+        start = 0
+        for block in blocks:
+            if start == 0:
+                header = ["region"] + [str(i) for i in range(block.shape[1])]
+                f.write(",".join(header) + "\n")
+
+            fmt = "%.9g" if block.dtype == np.float32 else "%.17g"
+            buf = StringIO()
+            np.savetxt(buf, block, fmt=fmt, delimiter=",")
+            names = region_names[start : start + block.shape[0]]
+            for name, line in zip(names, buf.getvalue().splitlines()):
+                f.write(f"{name},{line}\n")
+            start += block.shape[0]
+
+
 def do_merge(args, parser):
+    from .misc import get_state_embeddings, get_merged_embeddings
+
     if args.format is None:
         if args.infile.endswith(".npz"):
             args.format = "npz"
@@ -576,6 +848,8 @@ def do_merge(args, parser):
         with np.load(args.infile) as f:
             d = dict(**f)
     elif args.format == "hdf5":
+        import h5py
+
         with h5py.File(args.infile, "r") as f:
             d = {k: v[()] for k, v in f.items()}
     else:
@@ -597,15 +871,31 @@ def do_merge(args, parser):
 
 
 def do_weight_counts(args, parser):
+    import pandas as pd
+    from .featurize import read_total_weight
+
     if args.outfile is None:
-        args.outfile = os.path.join(args.dir, "weight_counts.csv")
+        args.outfile = args.dir / "weight_counts.csv"
 
-    mapping = {}
-    for fn in Path(args.dir).glob("feats_*"):
-        region = fn.stem[len("feats_") :]
-        mapping[region] = sum(chunk.PWGTP.sum() for chunk in read_file_chunks(fn))
+    feats = _list_feats(args.dir)
 
-    df = pd.DataFrame.from_dict(mapping, orient="index")
-    df.columns = ["total_wt"]
-    df.index.names = ["region"]
+    # Each file only needs its metadata or weight column read, so this is mostly
+    # waiting on IO; pyarrow releases the GIL, so threads are enough. PyTables
+    # isn't thread-safe, though, so stick to one thread if there are HDF5 files.
+    if all(fn.endswith((".pq", ".parquet")) for _, fn in feats):
+        n_threads = max(1, min(32, len(feats)))
+    else:
+        n_threads = 1
+
+    regions = np.empty(len(feats), dtype=object)
+    wts = np.empty(len(feats), dtype=np.int64)  # integer weight sums
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        futures = {}
+        for i, (region, fn) in enumerate(feats):
+            regions[i] = region
+            futures[pool.submit(read_total_weight, fn)] = i
+        for future in as_completed(futures):
+            wts[futures[future]] = future.result()
+
+    df = pd.DataFrame({"total_wt": wts}, index=pd.Index(regions, name="region"))
     df.to_csv(args.outfile)
@@ -2,11 +2,16 @@ from __future__ import division, print_function
 from collections import defaultdict
 from copy import deepcopy
 import ctypes
+import hashlib
 import itertools
+import json
+import multiprocessing
 from pathlib import Path
 import os
 import sys
+import tempfile
 import warnings
+import zipfile
 
 import numpy as np
 import pandas as pd
@@ -14,6 +19,8 @@ from scipy.linalg import qr
 from sklearn.metrics.pairwise import euclidean_distances
 from tqdm import tqdm
 
+from .sort import TOTAL_WT_KEY
+
 
 _cache_needs_nan = {}
 
@@ -198,6 +205,34 @@ def read_file_chunks(fn, format=None, columns=None, chunksize=2 ** 30):
         raise ValueError(f"unknown format {format!r}")
 
 
+def read_total_weight(fn, wt_col="PWGTP", format=None):
+    """
+    Gets the total of the `wt_col` column in a region file from `pummel sort`.
+    Uses the total saved in the file's metadata when there is one, and
+    otherwise (e.g. for files sorted by older versions) reads the column.
+    """
+    if format is None:
+        format = Path(fn).suffix[1:]
+
+    info = None
+    if format in {"hdf5", "hdf", "h5"}:
+        with pd.HDFStore(fn, "r") as store:
+            info = getattr(store.get_storer("df").attrs, TOTAL_WT_KEY, None)
+    elif format in {"parquet", "pq"}:
+        from pyarrow.parquet import read_schema
+
+        meta = read_schema(fn).metadata or {}
+        if TOTAL_WT_KEY.encode() in meta:
+            info = json.loads(meta[TOTAL_WT_KEY.encode()])
+    else:
+        raise ValueError(f"unknown format {format!r}")
+
+    if info is not None and info["wt_col"] == wt_col:
+        return info["total_wt"]
+    chunks = read_file_chunks(fn, format=format, columns=[wt_col])
+    return sum(chunk[wt_col].sum() for chunk in chunks)
+
+
 class Featurizer:
     def __init__(self, stats, **skip_kwargs):
         self.stats = stats
@@ -238,6 +273,7 @@ def get_embeddings(
     squeeze_queries=True,
     preprocessor=None,
     dtype=np.float64,
+    n_jobs=1,
 ):
     if subsets is None:
         n_subsets = 1
@@ -249,8 +285,6 @@ def get_embeddings(
         if n_subsets == 1:
             subsets += ","  # make sure eval returns a matrix
 
-        eval_args = {'engine': 'python'}  # :( https://github.com/pandas-dev/pandas/issues/25369
-
     if preprocessor is None:
         preprocessor = Preprocessor()  # a processor that only tracks skips
     stats = deepcopy(stats)
@@ -289,83 +323,42 @@ def get_embeddings(
     ]
     region_weights = np.empty((len(files), n_subsets))
 
-    dummies = np.empty((chunksize, len(big_feat_names)), dtype=dtype)
+    embedder = _RegionEmbedder(
+        stats=stats,
+        featurizers=featurizers,
+        each_include=each_include,
+        always_skip=always_skip,
+        n_feats=len(big_feat_names),
+        to_load=to_load,
+        preprocessor=preprocessor,
+        subsets=subsets,
+        n_subsets=n_subsets,
+        chunksize=chunksize,
+        dtype=dtype,
+    )
 
     with tqdm(
         total=stats["n_total"], unit="line", unit_scale=True, dynamic_ncols=True
     ) as bar:
-        for file_idx, file in enumerate(files):
-            bar.set_postfix(file=Path(file).stem)
-            weights = []
-            total_weights = 0
-            emb_pieces = [[] for f in featurizers]
-
-            # get mean embeddings for each chunk in the file
-            for c in read_file_chunks(file, chunksize=chunksize, columns=to_load):
-                bar.update(c.shape[0])
-
-                preprocessor(c)
-
-                # index into which lines are in which subsets,
-                # possibly working around gross pandas bug(?) for one-line dfs
-                if subsets is not None:
-                    if c.shape[0] == 1:
-                        which = pd.concat([c, c]).eval(subsets, **eval_args).astype(bool)[:, :1]
-                    else:
-                        which = c.eval(subsets, **eval_args).astype(bool)
-
-                    # remove lines not in any subset
-                    keep = which.any(axis=0)
-                    if not keep.all():
-                        c = c.loc[keep]
-                        which = which[:, keep]
-                        if not c.shape[0]:  # we subsetted away the entire chunk
-                            continue
-
-                # expand discrete variables, standardize reals, etc
-                if dummies.shape[0] < c.shape[0]:  # if chunksize not supported
-                    # .resize() is fidgety...
-                    dummies = np.empty((c.shape[0], dummies.shape[1]), dtype=dtype)
-                feats = dummies[: c.shape[0]]
-                get_dummies(
-                    c,
-                    stats,
-                    skip_feats=always_skip,
-                    ret_df=False,
-                    dtype=dtype,
-                    out=feats,
-                )
-
-                # figure out weights within each subset
-                wts = np.tile(c.PWGTP.astype(dtype), (n_subsets, 1))
-                if subsets is not None:
-                    for i, w in enumerate(which):
-                        wts[i, ~w] = 0
-
-                # get each set of feature means
-                for f, inc, pieces in zip(featurizers, each_include, emb_pieces):
-                    pieces.append(f(feats[:, inc], wts))
-
-                # track total weights for later
-                ws = wts.sum(axis=1)
-                weights.append(ws)
-                total_weights += ws
-
-            # figure out the weights for each chunk
-            ratios = []
-            for ws in weights:
-                ratio = np.array(ws, dtype=float, copy=True)
-                nz = total_weights != 0
-                ratio[nz] /= total_weights[nz]
-                ratios.append(ratio)
-
-            # build each embedding with appropriate weight
-            for final_embs, emb_pieces in zip(embeddings, emb_pieces):
-                final_embs[file_idx] = 0
-                for rs, e in zip(ratios, emb_pieces):
-                    final_embs[file_idx] += rs * e
-
-            region_weights[file_idx] = total_weights
+        if n_jobs == 1:
+            for file_idx, file in enumerate(files):
+                bar.set_postfix(file=Path(file).stem)
+                embs, total_weights, _ = embedder(file, progress=bar.update)
+                for final_embs, emb in zip(embeddings, embs):
+                    final_embs[file_idx] = emb
+                region_weights[file_idx] = total_weights
+        else:
+            # send the embedder (with its featurizers, frequencies, etc) to each
+            # worker once, rather than pickling it along with every file
+            with multiprocessing.Pool(
+                n_jobs, initializer=_init_embed_worker, initargs=(embedder,)
+            ) as pool:
+                results = pool.imap(_embed_worker, files)
+                for file_idx, (embs, total_weights, n_lines) in enumerate(results):
+                    bar.update(n_lines)
+                    for final_embs, emb in zip(embeddings, embs):
+                        final_embs[file_idx] = emb
+                    region_weights[file_idx] = total_weights
 
     if squeeze_queries and n_subsets == 1:
         embeddings = [np.squeeze(e, 2) for e in embeddings]
@@ -374,6 +367,146 @@ def get_embeddings(
     return embeddings, region_weights, featurizers
 
 
+class _RegionEmbedder:
+    """
+    Computes the embeddings for the file of a single region; see get_embeddings.
+    """
+
+    def __init__(
+        self,
+        stats,
+        featurizers,
+        each_include,
+        always_skip,
+        n_feats,
+        to_load,
+        preprocessor,
+        subsets,
+        n_subsets,
+        chunksize,
+        dtype,
+    ):
+        self.stats = stats
+        self.featurizers = featurizers
+        self.each_include = each_include
+        self.always_skip = always_skip
+        self.n_feats = n_feats
+        self.to_load = to_load
+        self.preprocessor = preprocessor
+        self.subsets = subsets
+        self.n_subsets = n_subsets
+        self.chunksize = chunksize
+        self.dtype = dtype
+        self.dummies = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["dummies"] = None  # don't bother sending the buffer around
+        return state
+
+    def __call__(self, file, progress=None):
+        """
+        Returns a list of embeddings (one per featurizer, each of shape
+        `out_size x n_subsets`), the total weights in each subset, and the
+        number of lines in the file.
+        """
+        subsets = self.subsets
+        n_subsets = self.n_subsets
+        dtype = self.dtype
+        eval_args = {'engine': 'python'}  # :( https://github.com/pandas-dev/pandas/issues/25369
+
+        if self.dummies is None:
+            self.dummies = np.empty((self.chunksize, self.n_feats), dtype=dtype)
+
+        weights = []
+        total_weights = 0
+        n_lines = 0
+        emb_pieces = [[] for f in self.featurizers]
+
+        # get mean embeddings for each chunk in the file
+        for c in read_file_chunks(file, chunksize=self.chunksize, columns=self.to_load):
+            n_lines += c.shape[0]
+            if progress is not None:
+                progress(c.shape[0])
+
+            self.preprocessor(c)
+
+            # index into which lines are in which subsets,
+            # possibly working around gross pandas bug(?) for one-line dfs
+            if subsets is not None:
+                if c.shape[0] == 1:
+                    which = pd.concat([c, c]).eval(subsets, **eval_args).astype(bool)[:, :1]
+                else:
+                    which = c.eval(subsets, **eval_args).astype(bool)
+
+                # remove lines not in any subset
+                keep = which.any(axis=0)
+                if not keep.all():
+                    c = c.loc[keep]
+                    which = which[:, keep]
+                    if not c.shape[0]:  # we subsetted away the entire chunk
+                        continue
+
+            # expand discrete variables, standardize reals, etc
+            if self.dummies.shape[0] < c.shape[0]:  # if chunksize not supported
+                # .resize() is fidgety...
+                self.dummies = np.empty((c.shape[0], self.n_feats), dtype=dtype)
+            feats = self.dummies[: c.shape[0]]
+            get_dummies(
+                c,
+                self.stats,
+                skip_feats=self.always_skip,
+                ret_df=False,
+                dtype=dtype,
+                out=feats,
+            )
+
+            # figure out weights within each subset
+            wts = np.tile(c.PWGTP.astype(dtype), (n_subsets, 1))
+            if subsets is not None:
+                for i, w in enumerate(which):
+                    wts[i, ~w] = 0
+
+            # get each set of feature means
+            for f, inc, pieces in zip(self.featurizers, self.each_include, emb_pieces):
+                pieces.append(f(feats[:, inc], wts))
+
+            # track total weights for later
+            ws = wts.sum(axis=1)
+            weights.append(ws)
+            total_weights += ws
+
+        # figure out the weights for each chunk
+        ratios = []
+        for ws in weights:
+            ratio = np.array(ws, dtype=float, copy=True)
+            nz = total_weights != 0
+            ratio[nz] /= total_weights[nz]
+            ratios.append(ratio)
+
+        # build each embedding with appropriate weight
+        embs = []
+        for f, pieces in zip(self.featurizers, emb_pieces):
+            emb = np.zeros((f.out_size, n_subsets))
+            for rs, e in zip(ratios, pieces):
+                emb += rs * e
+            embs.append(emb)
+
+        return embs, total_weights, n_lines
+
+
+_worker_embedder = None
+
+
+def _init_embed_worker(embedder):
+    global _worker_embedder
+    _worker_embedder = embedder
+
+
+def _embed_worker(file):
+    return _worker_embedder(file)
+
+
 ################################################################################
 
 
@@ -411,6 +544,8 @@ _sincos = None
 
 
 def _get_sincos(mkl_path=None):
+    # The returned function gives (sin(inp), cos(inp)), reusing inp's memory for
+    # the cosines (so inp is overwritten) to avoid allocating another array.
     global _sincos
     if _sincos is None:
         if mkl_path is None:
@@ -421,7 +556,8 @@ def _get_sincos(mkl_path=None):
         except OSError:
 
             def np_sincos(inp):
-                return np.sin(inp), np.cos(inp)
+                out_sin = np.sin(inp)
+                return out_sin, np.cos(inp, out=inp)
 
             _sincos = np_sincos
         else:
@@ -440,10 +576,10 @@ def _get_sincos(mkl_path=None):
             fn = {"<f4": sincos_s, "<f8": sincos_d}
 
             def mkl_sincos(inp):
+                # VML functions work elementwise, so in-place output is fine
                 out_sin = np.empty_like(inp)
-                out_cos = np.empty_like(inp)
-                fn[inp.dtype.str](inp.size, inp, out_sin, out_cos)
-                return out_sin, out_cos
+                fn[inp.dtype.str](inp.size, inp, out_sin, inp)
+                return out_sin, inp
 
             _sincos = mkl_sincos
     return _sincos
@@ -458,6 +594,7 @@ def rff_embedding(feats, wts, freqs, out=None):
     if out is None:
         out = np.empty((2 * D, wts.shape[0]), dtype=feats.dtype)
 
+    # the angles are a fresh array, so it's fine that this overwrites them
     sin_angles, cos_angles = _get_sincos()(np.dot(feats, freqs))
 
     np.dot(sin_angles.T, wts.T, out=out[:D])
@@ -524,6 +661,48 @@ def _get_median(samp):
     return np.sqrt(np.median(D2[np.triu_indices_from(D2, k=1)]))
 
 
+def _load_cached_freqs(cache_fn):
+    "Returns (freqs, bandwidth) from a cache file, or None if it's missing or bad."
+    try:
+        with np.load(cache_fn) as d:
+            return d["freqs"], float(d["bandwidth"])
+    except FileNotFoundError:
+        return None
+    except (zipfile.BadZipFile, KeyError, ValueError, EOFError, OSError) as e:
+        warnings.warn(f"Ignoring unreadable frequency cache {cache_fn}: {e}")
+        return None
+
+
+def _save_cached_freqs(cache_fn, freqs, bandwidth):
+    """
+    Saves frequencies to a cache file. Writes to a temporary file first and then
+    renames it, so that an interrupted run or a concurrent one never leaves a
+    partial file at cache_fn. Caching is only an optimization, so failures (e.g.
+    a read-only directory) just warn.
+    """
+    cache_fn = Path(cache_fn)
+    try:
+        fd, tmp_name = tempfile.mkstemp(
+            dir=cache_fn.parent, prefix=cache_fn.stem + ".", suffix=".tmp"
+        )
+    except OSError as e:
+        warnings.warn(f"Couldn't cache frequencies in {cache_fn}: {e}")
+        return
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, freqs=freqs, bandwidth=bandwidth)
+        os.replace(tmp_name, cache_fn)
+    except BaseException as e:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        if not isinstance(e, OSError):
+            raise
+        warnings.warn(f"Couldn't cache frequencies in {cache_fn}: {e}")
+
+
 class RFFFeaturizer(Featurizer):
     def __init__(
         self,
@@ -534,6 +713,7 @@ class RFFFeaturizer(Featurizer):
         orthogonal=True,
         seed=None,
         dtype=None,
+        cache_dir=None,
         **kwargs,
     ):
         super().__init__(stats, **kwargs)
@@ -542,21 +722,53 @@ class RFFFeaturizer(Featurizer):
         self.bandwidth = bandwidth
 
         if freqs is None:
-            if bandwidth is None:
-                # print(
-                #     "Picking bandwidth by median heuristic...", file=sys.stderr, end=""
-                # )
-                self.bandwidth = bandwidth = pick_gaussian_bandwidth(
-                    stats, skip_feats=self.skip_feats
+            n_feats = _num_feats(stats, skip_feats=self.skip_feats)
+
+            # With a fixed seed, the frequencies (and median-heuristic bandwidth)
+            # are a deterministic function of these settings, so we can save them
+            # in cache_dir and skip regenerating them next time.
+            cache_fn = None
+            if cache_dir is not None and seed is not None:
+                # the median-heuristic bandwidth depends on exactly which features
+                # there are and on the (preprocessed) sample, so hash those too
+                feat_names, _ = _feat_names_ids(stats, skip_feats=self.skip_feats)
+                key = (
+                    seed,
+                    n_freqs,
+                    bandwidth,
+                    orthogonal,
+                    feat_names,
+                    stats["version"],
+                    int(stats["n_total"]),
+                    float(stats["wt_total"]),
                 )
-                # print("picked {}".format(bandwidth), file=sys.stderr)
-            freqs = pick_rff_freqs(
-                n_freqs,
-                bandwidth,
-                seed=seed,
-                n_feats=_num_feats(stats, skip_feats=self.skip_feats),
-                orthogonal=orthogonal,
-            )
+                h = hashlib.sha1(repr(key).encode())
+                sample_hashes = pd.util.hash_pandas_object(stats["sample"], index=False)
+                h.update(sample_hashes.values.tobytes())
+                cache_fn = Path(cache_dir) / f"freqs_{h.hexdigest()[:12]}.npz"
+
+            cached = None if cache_fn is None else _load_cached_freqs(cache_fn)
+            if cached is not None:
+                freqs, bandwidth = cached
+                self.bandwidth = bandwidth
+            else:
+                if bandwidth is None:
+                    # print(
+                    #     "Picking bandwidth by median heuristic...", file=sys.stderr, end=""
+                    # )
+                    self.bandwidth = bandwidth = pick_gaussian_bandwidth(
+                        stats, skip_feats=self.skip_feats
+                    )
+                    # print("picked {}".format(bandwidth), file=sys.stderr)
+                freqs = pick_rff_freqs(
+                    n_freqs,
+                    bandwidth,
+                    seed=seed,
+                    n_feats=n_feats,
+                    orthogonal=orthogonal,
+                )
+                if cache_fn is not None:
+                    _save_cached_freqs(cache_fn, freqs, bandwidth)
         if dtype is not None:
             freqs = freqs.astype(dtype)
         self.freqs = freqs
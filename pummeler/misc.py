@@ -1,6 +1,7 @@
 from __future__ import print_function, division
 
 import numpy as np
+from scipy import sparse
 
 from .data import geocode_data
 
@@ -14,32 +15,35 @@ def merge_embeddings(embeddings, region_weights, region_maps):
 
     m_names = sorted(set(region_maps))
     m_names_lookup = {n: i for i, n in enumerate(m_names)}
-
-    transform = np.zeros((len(m_names), embeddings[0].shape[0], n_subsets))
-    for r_i, (m, w) in enumerate(zip(region_maps, region_weights)):
-        transform[m_names_lookup[m], r_i, :] = w
-
-    m_weights = transform.sum(axis=1)
-
-    # normalize transform so that its sum along axis 1 is 1
-    # this is kind of gross to allow for zero sums...maybe there's a better way
-    nz = np.broadcast_to((m_weights != 0)[:, np.newaxis, :], transform.shape)
-    transform[nz] /= np.broadcast_to(m_weights[:, np.newaxis, :], transform.shape)[nz]
+    m_idx = np.array([m_names_lookup[m] for m in region_maps], dtype=int)
+    n_regions = len(m_idx)
+
+    m_weights = np.zeros((len(m_names), n_subsets))
+    np.add.at(m_weights, m_idx, region_weights)
+
+    # each region's share of its merged region's weight, allowing for zero sums
+    m_totals = m_weights[m_idx]
+    ratios = np.zeros((n_regions, n_subsets))
+    np.divide(region_weights, m_totals, out=ratios, where=m_totals != 0)
+
+    # the transform for each subset only has one nonzero per region, so keep it
+    # sparse rather than materializing n_merged x n_regions x n_subsets of zeros
+    transforms = [
+        sparse.csr_matrix(
+            (ratios[:, i], (m_idx, np.arange(n_regions))),
+            shape=(len(m_names), n_regions),
+        )
+        for i in range(n_subsets)
+    ]
 
     m_embeddings = []
     for emb in embeddings:
         if squeezed:
             emb = emb[:, :, np.newaxis]
 
-        # need to do a matrix multiply for each subset:
-        #  - np.einsum('grs,rfs->gfs') would do this, but doesn't call BLAS
-        #  - rolling the subset axis to the front and calling np.matmul
-        #    would do this, but it just calls einsum anyway:
-        #    https://github.com/numpy/numpy/issues/7569
-
         out = np.empty((n_subsets, len(m_names), emb.shape[1]))
         for i in range(n_subsets):
-            np.dot(transform[:, :, i], emb[:, :, i], out=out[i])
+            out[i] = transforms[i].dot(emb[:, :, i])
         m_emb = np.rollaxis(out, 0, 3)
         if squeezed:
             m_emb = np.squeeze(m_emb, 2)
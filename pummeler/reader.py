@@ -2,8 +2,6 @@ from copy import deepcopy
 from functools import lru_cache
 from pathlib import Path
 
-import pandas as pd
-
 
 weirds = """
     SERIALNO
@@ -24,6 +22,8 @@ def read_chunks(
     housing_source=None,  # func from (state, puma) => filename
     housing_cache_size=8,
 ):
+    import pandas as pd  # imported here so VERSIONS is cheap to import
+
     info = VERSIONS[version]
     dtypes = {}
     for k in info["meta_cols"] + info["discrete_feats"] + info["alloc_flags"]:
@@ -65,8 +65,11 @@ def read_chunks(
             )
             return df
 
+    # skip parsing the columns we're going to ignore anyway
+    drop_feats = frozenset(info.get("drop_feats", ()))
     chunks = pd.read_csv(
         fname,
+        usecols=(lambda k: k not in drop_feats) if drop_feats else None,
         skipinitialspace=True,
         na_values={k: ["N.A.", "N.A.//", "N.A.////"] for k in weirds},
         dtype=dtypes,
@@ -89,9 +92,6 @@ def read_chunks(
         if chunk.shape[0] == 0:
             continue
 
-        if "drop_feats" in info:  # TODO: pass usecols to read_csv instead...
-            chunk.drop(info["drop_feats"], axis=1, inplace=True)
-
         if "renames" in info:
             if renames is None:
                 renames = [info["renames"].get(k, k) for k in chunk.columns]
@@ -1,6 +1,8 @@
 from __future__ import division, print_function
 from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import heapq
+import json
 import os
 from pathlib import Path
 import zipfile
@@ -45,6 +47,34 @@ def get_puma_to_region(region_type, puma_year):
     return puma_to_region
 
 
+class HousingSource:
+    """
+    Finds the file in housing_dir, the output of sorting housing records, that
+    has the records for a given (state, puma). Unlike a closure, this can be
+    pickled to send to worker processes.
+    """
+
+    def __init__(self, housing_dir, region_type, region_year):
+        self.housing_dir = Path(housing_dir)
+        self.region_type = region_type
+        self.region_year = region_year
+        self._get_name = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_get_name"] = None
+        return state
+
+    def __call__(self, st, puma):
+        if self._get_name is None:
+            self._get_name = get_puma_to_region(self.region_type, self.region_year)
+        name = self._get_name((st, puma))
+        return next(iter(self.housing_dir.glob(f"feats_{name}.*")))
+
+
+# name of the file metadata entry where merge_chunks saves the total weight
+TOTAL_WT_KEY = "pummeler_total_wt"
+
 _ignore_cols = {"ADJINC", "ADJINC_orig", "ADJHSG", "ADJHSG_orig"}
 
 
@@ -63,25 +93,15 @@ def sort_by_region(
     region_type="puma_county",
     format="parquet",
     add_extension=False,
+    n_jobs=1,
 ):
     if housing_source:
         info = version_info_with_housing(version)
     else:
         info = VERSIONS[version]
-    all_cols = set(
-        info["meta_cols"]
-        + info["weight_cols"]
-        + info["real_feats"]
-        + info["discrete_feats"]
-        + info["alloc_flags"]
-    )
-    real_feats = info["real_feats"]
-    discrete = info["discrete_feats"] + info["alloc_flags"]
     wt_col = info["weight_cols"][0]
     assert wt_col.isalpha()  # PWGTP or WGTP, not PWGT6 or whatever
 
-    puma_to_region = get_puma_to_region(region_type, info["region_year"])
-
     if format.lower() in {"hdf", "hdf5", "h5"}:
         format = "hdf5"
         if add_extension:
@@ -93,35 +113,38 @@ def sort_by_region(
     else:
         raise ValueError(f"unknown format {format!r}")
 
-    real_info = []  # (num non-nan, mean series, mean of square series) entries
-    value_counts = {}  # column name => sum of col.value_counts()
-
-    n_total = 0
-    wt_total = 0
-    not_in_region = Counter()
-
     if isinstance(source, list):
         files = source
-        opener = open
+        zip_source = None
         sizes = [os.path.getsize(fn) for fn in files]
     else:
-        z = zipfile.ZipFile(source, "r")  # close through GC :|
-        opener = z.open
-        files = [fn for fn in z.namelist() if fn.endswith(".csv")]
-        sizes = [z.getinfo(fn).file_size for fn in files]
-
-    # We're going to use weighted reservoir sampling to keep a few random rows
-    # in memory, so we can estimate the median pairwise distance between
-    # features later.
-    reservoir = []
-
-    columns = None
+        zip_source = source
+        with zipfile.ZipFile(source, "r") as z:
+            files = [fn for fn in z.namelist() if fn.endswith(".csv")]
+            sizes = [z.getinfo(fn).file_size for fn in files]
+
+    sorter = _FileSorter(
+        zip_source=zip_source,
+        out_fmt=out_fmt,
+        info=info,
+        voters_only=voters_only,
+        adj_inc=adj_inc,
+        adj_hsg=adj_hsg,
+        housing_source=housing_source,
+        housing_cache_size=housing_cache_size,
+        version=version,
+        chunksize=chunksize,
+        n_to_sample=n_to_sample,
+        stats_only=stats_only,
+        region_type=region_type,
+        format=format,
+    )
 
-    # We'll write each chunk into a separate small file for now,
-    # then merge at the end. (The good file formats for featurization aren't
-    # super append-friendly.)
-    file_parts = defaultdict(list)
+    # Each file gets its own random stream for its reservoir sample, so that
+    # worker processes don't all share (copies of) the same one.
+    seeds = np.random.randint(2 ** 31, size=len(files))
 
+    results = [None] * len(files)
     with tqdm(
         total=sum(sizes),
         unit="B",
@@ -129,95 +152,57 @@ def sort_by_region(
         unit_divisor=1024,
         dynamic_ncols=True,
     ) as bar:
-        for file, size in zip(files, sizes):
-            start_size = bar.n
-            bar.set_postfix(file=file)
-
-            checked_cols = False
-            with opener(file, "r") as in_f:
-                for chunk in read_chunks(
-                    in_f,
-                    voters_only=voters_only,
-                    adj_inc=adj_inc,
-                    adj_hsg=adj_hsg,
-                    housing_source=housing_source,
-                    housing_cache_size=housing_cache_size,
-                    chunksize=chunksize,
-                    version=version,
-                ):
-                    if not checked_cols:
-                        if columns is None:
-                            columns = list(chunk.columns)
-
-                            cols = set(chunk.columns)
-                            extra = cols - all_cols - _ignore_cols
-                            if extra:
-                                msg = (
-                                    "Saw unknown columns; did you pass the "
-                                    "right PUMS file version?\n{}"
-                                )
-                                raise ValueError(msg.format(", ".join(extra)))
-                            missing = all_cols - cols
-                            if missing:
-                                msg = (
-                                    "Didn't see expected columns; did you pass "
-                                    "the right PUMS file version?\n{}"
-                                )
-                                raise ValueError(msg.format(", ".join(missing)))
-                        else:
-                            assert list(chunk.columns) == columns
-                        checked_cols = True
-
-                    n_total += chunk.shape[0]
-                    wt_total += chunk[wt_col].sum()
-
-                    # components of mean / std for real-valued features
-                    reals = chunk[real_feats]
-                    real_info.append(
-                        (
-                            reals.shape[0] - reals.isnull().sum(),
-                            reals.mean(),
-                            (reals.astype(np.float128) ** 2).mean(),
-                        )
-                    )
+        if n_jobs == 1:
+            for file_idx, file in enumerate(files):
+                start_size = bar.n
+                bar.set_postfix(file=file)
 
-                    # add onto value counts for discrete features
-                    for k in discrete:
-                        value_counts[k] = (
-                            chunk[k]
-                            .value_counts()
-                            .add(value_counts.get(k, 0), fill_value=0)
-                        )
-
-                    # manage reservoir sample
-                    rs = np.asarray(
-                        np.random.uniform(size=chunk.shape[0]) ** (1 / chunk[wt_col])
-                    )
-                    for r_tup in zip(rs, chunk.itertuples(index=False)):
-                        # TODO: could speed this up if it's slow, probably
-                        # maybe there's a weighted version of
-                        # http://erikerlandson.github.io/blog/2015/11/20/very-fast-reservoir-sampling/
-                        if len(reservoir) < n_to_sample:
-                            heapq.heappush(reservoir, r_tup)
-                        else:
-                            heapq.heappushpop(reservoir, r_tup)
-
-                    # output into parts of files by region
-                    if not stats_only:
-                        regions = np.empty(chunk.shape[0], dtype=object)
-                        for i, tup in enumerate(zip(chunk.ST, chunk.PUMA)):
-                            regions[i] = r = puma_to_region(tup)
-                            if r is None:
-                                not_in_region[tup] += 1
-
-                        for r, r_chunk in chunk.groupby(regions):
-                            target_name = out_fmt.format(r)
-                            parts = file_parts[target_name]
-                            fn = f"{target_name}.part{len(parts)+1}"
-                            write_chunk(fn, r_chunk, format=format)
-                            parts.append(fn)
-
-                    bar.update(start_size + in_f.tell() - bar.n)
+                def progress(pos):
+                    bar.update(start_size + pos - bar.n)
+
+                results[file_idx] = sorter(
+                    file, file_idx, seeds[file_idx], progress=progress
+                )
+        else:
+            with ProcessPoolExecutor(n_jobs) as pool:
+                futures = {
+                    pool.submit(sorter, file, file_idx, seeds[file_idx]): file_idx
+                    for file_idx, file in enumerate(files)
+                }
+                for future in as_completed(futures):
+                    file_idx = futures[future]
+                    results[file_idx] = future.result()
+                    bar.set_postfix(file=files[file_idx])
+                    bar.update(sizes[file_idx])
+
+    # combine the per-file results, in file order
+    real_info = []  # (num non-nan, mean series, mean of square series) entries
+    value_counts = {}  # column name => sum of col.value_counts()
+    n_total = 0
+    wt_total = 0
+    not_in_region = Counter()
+    reservoir = []
+    columns = None
+    file_parts = defaultdict(list)
+    for res in results:
+        if res["columns"] is not None:
+            if columns is None:
+                columns = res["columns"]
+            else:
+                assert res["columns"] == columns
+
+        real_info += res["real_info"]
+        for k, vc in res["value_counts"].items():
+            value_counts[k] = vc.add(value_counts.get(k, 0), fill_value=0)
+        n_total += res["n_total"]
+        wt_total += res["wt_total"]
+        not_in_region += res["not_in_region"]
+        reservoir += res["reservoir"]
+        for target_name, parts in res["file_parts"].items():
+            file_parts[target_name] += parts
+
+    # each file kept its top weighted keys; keep the top of all of those
+    reservoir = heapq.nlargest(n_to_sample, reservoir, key=lambda r_tup: r_tup[0])
 
     if not_in_region:
         print("Records not in a region:")
@@ -228,7 +213,9 @@ def sort_by_region(
         print("Merging files...")
         dtypes = {k: pd.CategoricalDtype(v.index) for k, v in value_counts.items()}
         for target_file, part_names in tqdm(file_parts.items()):
-            merge_chunks(part_names, target_file, format=format, dtypes=dtypes)
+            merge_chunks(
+                part_names, target_file, format=format, dtypes=dtypes, wt_col=wt_col
+            )
 
     real_totals = sum(n_nonnan for n_nonnan, mean, mean_sq in real_info)
     real_means = 0
@@ -257,11 +244,187 @@ def sort_by_region(
     return stats
 
 
+class _FileSorter:
+    """
+    Collects the statistics for one PUMS CSV file and, unless stats_only, writes
+    its records into per-region part files; see sort_by_region. Picklable, so
+    that files can be processed in separate processes.
+    """
+
+    def __init__(
+        self,
+        zip_source,
+        out_fmt,
+        info,
+        voters_only,
+        adj_inc,
+        adj_hsg,
+        housing_source,
+        housing_cache_size,
+        version,
+        chunksize,
+        n_to_sample,
+        stats_only,
+        region_type,
+        format,
+    ):
+        self.zip_source = zip_source
+        self.out_fmt = out_fmt
+        self.info = info
+        self.voters_only = voters_only
+        self.adj_inc = adj_inc
+        self.adj_hsg = adj_hsg
+        self.housing_source = housing_source
+        self.housing_cache_size = housing_cache_size
+        self.version = version
+        self.chunksize = chunksize
+        self.n_to_sample = n_to_sample
+        self.stats_only = stats_only
+        self.region_type = region_type
+        self.format = format
+
+    def __call__(self, file, file_idx, seed, progress=None):
+        if self.zip_source is None:
+            with open(file, "r") as in_f:
+                return self._sort(in_f, file_idx, seed, progress)
+        else:
+            with zipfile.ZipFile(self.zip_source, "r") as z:
+                with z.open(file, "r") as in_f:
+                    return self._sort(in_f, file_idx, seed, progress)
+
+    def _sort(self, in_f, file_idx, seed, progress):
+        info = self.info
+        all_cols = set(
+            info["meta_cols"]
+            + info["weight_cols"]
+            + info["real_feats"]
+            + info["discrete_feats"]
+            + info["alloc_flags"]
+        )
+        real_feats = info["real_feats"]
+        discrete = info["discrete_feats"] + info["alloc_flags"]
+        wt_col = info["weight_cols"][0]
+        n_to_sample = self.n_to_sample
+
+        puma_to_region = get_puma_to_region(self.region_type, info["region_year"])
+        rand = np.random.RandomState(seed)
+
+        real_info = []  # (num non-nan, mean series, mean of square series) entries
+        value_counts = {}  # column name => sum of col.value_counts()
+
+        n_total = 0
+        wt_total = 0
+        not_in_region = Counter()
+
+        # We're going to use weighted reservoir sampling to keep a few random
+        # rows in memory, so we can estimate the median pairwise distance
+        # between features later.
+        reservoir = []
+
+        columns = None
+
+        # We'll write each chunk into a separate small file for now,
+        # then merge at the end. (The good file formats for featurization aren't
+        # super append-friendly.)
+        file_parts = defaultdict(list)
+
+        for chunk in read_chunks(
+            in_f,
+            voters_only=self.voters_only,
+            adj_inc=self.adj_inc,
+            adj_hsg=self.adj_hsg,
+            housing_source=self.housing_source,
+            housing_cache_size=self.housing_cache_size,
+            chunksize=self.chunksize,
+            version=self.version,
+        ):
+            if columns is None:
+                columns = list(chunk.columns)
+
+                cols = set(chunk.columns)
+                extra = cols - all_cols - _ignore_cols
+                if extra:
+                    msg = (
+                        "Saw unknown columns; did you pass the "
+                        "right PUMS file version?\n{}"
+                    )
+                    raise ValueError(msg.format(", ".join(extra)))
+                missing = all_cols - cols
+                if missing:
+                    msg = (
+                        "Didn't see expected columns; did you pass "
+                        "the right PUMS file version?\n{}"
+                    )
+                    raise ValueError(msg.format(", ".join(missing)))
+
+            n_total += chunk.shape[0]
+            wt_total += chunk[wt_col].sum()
+
+            # components of mean / std for real-valued features
+            reals = chunk[real_feats]
+            real_info.append(
+                (
+                    reals.shape[0] - reals.isnull().sum(),
+                    reals.mean(),
+                    (reals.astype(np.float128) ** 2).mean(),
+                )
+            )
+
+            # add onto value counts for discrete features
+            for k in discrete:
+                value_counts[k] = (
+                    chunk[k].value_counts().add(value_counts.get(k, 0), fill_value=0)
+                )
+
+            # manage reservoir sample
+            rs = np.asarray(rand.uniform(size=chunk.shape[0]) ** (1 / chunk[wt_col]))
+            for r_tup in zip(rs, chunk.itertuples(index=False, name=None)):
+                # TODO: could speed this up if it's slow, probably
+                # maybe there's a weighted version of
+                # http://erikerlandson.github.io/blog/2015/11/20/very-fast-reservoir-sampling/
+                if len(reservoir) < n_to_sample:
+                    heapq.heappush(reservoir, r_tup)
+                else:
+                    heapq.heappushpop(reservoir, r_tup)
+
+            # output into parts of files by region
+            if not self.stats_only:
+                regions = np.empty(chunk.shape[0], dtype=object)
+                for i, tup in enumerate(zip(chunk.ST, chunk.PUMA)):
+                    regions[i] = r = puma_to_region(tup)
+                    if r is None:
+                        not_in_region[tup] += 1
+
+                for r, r_chunk in chunk.groupby(regions):
+                    target_name = self.out_fmt.format(r)
+                    parts = file_parts[target_name]
+                    fn = f"{target_name}.part{file_idx}_{len(parts)+1}"
+                    write_chunk(fn, r_chunk, format=self.format)
+                    parts.append(fn)
+
+            if progress is not None:
+                progress(in_f.tell())
+
+        return {
+            "columns": columns,
+            "real_info": real_info,
+            "value_counts": value_counts,
+            "n_total": n_total,
+            "wt_total": wt_total,
+            "not_in_region": not_in_region,
+            "reservoir": reservoir,
+            "file_parts": dict(file_parts),
+        }
+
+
 def write_chunk(fn, df, format):
     if format == "parquet":
         df.to_parquet(fn, row_group_size=65536)
     elif format == "hdf5":
-        df.to_hdf(fn, "df", format="table", mode="w", complib="blosc", complevel=6)
+        # these are only read once, by merge_chunks; favor speed over size
+        df.to_hdf(
+            fn, "df", format="table", mode="w", complib="blosc:lz4", complevel=1
+        )
     else:
         raise ValueError(f"unknown format {format!r}")
 
@@ -293,24 +456,46 @@ def astype_catorder(df, dtypes, copy=True, errors="raise"):
     return result
 
 
-def merge_chunks(in_files, out_fn, format, dtypes):
+def merge_chunks(in_files, out_fn, format, dtypes, wt_col=None):
     # we want to make sure the categories attributes all agree, even in order.
     # this means we (a) can't just copy files even if there's only one,
     # and (b) have to use astype_catorder to make sure they're right
     # since astype won't reorder unordered dtypes
 
+    # If wt_col is given, we also save its total in the file's metadata, so that
+    # read_total_weight doesn't need to read the data to get it.
+
     if format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
         df = pd.concat(
             [astype_catorder(pd.read_parquet(fn), dtypes) for fn in in_files]
         )
-        df.to_parquet(out_fn, row_group_size=65536)
+        table = pa.Table.from_pandas(df)
+        if wt_col is not None:
+            meta = dict(table.schema.metadata or {})
+            meta[TOTAL_WT_KEY.encode()] = json.dumps(_wt_info(df, wt_col)).encode()
+            table = table.replace_schema_metadata(meta)
+        pq.write_table(table, out_fn, row_group_size=65536)
     elif format == "hdf5":
         df = pd.concat(
             [astype_catorder(pd.read_hdf(fn, "df"), dtypes) for fn in in_files]
         )
-        df.to_hdf(out_fn, "df", format="table", mode="w", complib="blosc", complevel=6)
+        # let PyTables size the (blosc-compressed, byte-shuffled) chunks for the
+        # whole table, instead of guessing from its default expected size;
+        # to_hdf doesn't pass expectedrows through, but HDFStore.append does
+        with pd.HDFStore(out_fn, "w", complib="blosc", complevel=6) as store:
+            store.append("df", df, format="table", expectedrows=df.shape[0])
+            if wt_col is not None:
+                attrs = store.get_storer("df").attrs
+                setattr(attrs, TOTAL_WT_KEY, _wt_info(df, wt_col))
     else:
         raise ValueError(f"unknown format {format!r}")
 
     for fn in in_files:
         Path(fn).unlink()
+
+
+def _wt_info(df, wt_col):
+    return {"wt_col": wt_col, "total_wt": int(df[wt_col].sum())}